@@ -1,22 +1,78 @@
 from fastapi import HTTPException, Request, FastAPI
-from collections import defaultdict, deque
-from fastapi.responses import JSONResponse
-from typing import Dict, List, Callable
+from collections import defaultdict, deque, OrderedDict
+from fastapi.responses import Response
+from typing import Dict, List, Callable, MutableMapping, Iterator, Iterable, Optional, Tuple
 from dataclasses import dataclass
 import time as time_module
+import sys
 import asyncio
 
-# Define a dataclass to store request statistics
-@dataclass
+# Detail message returned to clients when their request is rate limited
+DENIED_DETAIL = "Rate limit exceeded. Try again in {:.2f} seconds."
+
+# Prebuilt JSON body around the wait time for rate-limited responses, matching what JSONResponse would render
+DENIED_BODY_PREFIX = b'{"detail":"Rate limit exceeded. Try again in '
+DENIED_BODY_SUFFIX = b' seconds."}'
+
+# Define a dataclass to store request statistics (last_allowed and last_denied are wall-clock times from time.time())
+# Fields are stored in slots instead of a per-instance dict on Python versions that support slotted dataclasses
+@dataclass(**({"slots": True} if sys.version_info >= (3, 10) else {}))
 class RequestStats:
     allowed: int = 0
     denied: int = 0
     last_allowed: float = 0
     last_denied: float = 0
 
+# Define a mapping view over one column of the rate limiter's per-key bucket storage
+class BucketColumn(MutableMapping):
+    def __init__(self, limiter: "RateLimiter", column: str):
+        # Keep a reference to the owning limiter and the name of the column list being exposed
+        self._limiter = limiter
+        self._column = column
+
+    def __getitem__(self, key: str) -> float:
+        return getattr(self._limiter, self._column)[self._limiter._idx[key]]
+
+    def __setitem__(self, key: str, value: float):
+        # Allocate a fresh row for unknown keys, then overwrite this column's cell
+        i = self._limiter._idx.get(key)
+        if i is None:
+            i = self._limiter._add_row(key, self._limiter._now())
+        getattr(self._limiter, self._column)[i] = value
+
+    def __delitem__(self, key: str):
+        self._limiter._drop_row(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._limiter._idx)
+
+    def __len__(self) -> int:
+        return len(self._limiter._idx)
+
+# Define a list of callbacks that has the owning rate limiter reclassify them whenever the list changes
+class CallbackList(list):
+    def __init__(self, limiter: "RateLimiter", callbacks: Iterable[Callable] = ()):
+        super().__init__(callbacks)
+        self._limiter = limiter
+
+# Wrap every list method that changes the contents so the limiter sees each change
+def _reclassifying(name: str):
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        result = method(self, *args)
+        self._limiter._classify_callbacks()
+        return result
+
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ("append", "extend", "insert", "remove", "pop", "clear", "sort", "reverse", "__setitem__", "__delitem__", "__iadd__", "__imul__"):
+    setattr(CallbackList, _name, _reclassifying(_name))
+
 # Define a RateLimiter class to handle rate limiting
 class RateLimiter:
-    def __init__(self, rate: int, capacity: int = 1024, burst: int = None, stats_window: int = 60, enable_stats: bool = True, seconds: int = 0, minutes: int = 0, hours: int = 0):
+    def __init__(self, rate: int, capacity: int = 1024, burst: int = None, stats_window: int = 60, enable_stats: bool = True, seconds: int = 0, minutes: int = 0, hours: int = 0, max_keys: Optional[int] = None):
         """
         Initializes a RateLimiter instance.
 
@@ -29,6 +85,7 @@ class RateLimiter:
             seconds (int, at least one of seconds, minutes, or hours must be provided): Number of seconds.
             minutes (int, at least one of seconds, minutes, or hours must be provided): Number of minutes.
             hours (int, at least one of seconds, minutes, or hours must be provided): Number of hours.
+            max_keys (int, optional): Maximum number of keys tracked at once; beyond it, keys are evicted starting from the least recently used one, with frequently used keys getting extra passes. Unbounded if not provided.
         """
         
         # Calculate total time in seconds from hours, minutes, and seconds
@@ -49,6 +106,9 @@ class RateLimiter:
         # Validate the stats window
         if stats_window <= 0:
             raise ValueError("The stats window must be greater than zero.")
+        # Validate the maximum number of keys
+        if max_keys is not None and max_keys <= 0:
+            raise ValueError("The maximum number of keys must be greater than zero.")
                 
         # Initialize rate, capacity
         self.rate = rate
@@ -57,91 +117,291 @@ class RateLimiter:
         # Initialize burst if provided, otherwise default to 0
         self.burst = burst if burst is not None else 0
         
+        # Precompute the refill rate per second and the bucket ceiling used on every request
+        self._refresh_limits()
+
         # Initialize stats window and stats tracking
         self.stats_window = stats_window
-        self.enable_stats = enable_stats
+        # Set the flag directly here; the processing path is picked once the callbacks are set up below
+        self._enable_stats = enable_stats
 
-        # Initialize token buckets and last refill timestamps for each client/request key
-        self.tokens: Dict[str, float] = defaultdict(lambda: self.capacity + self.burst)
-        self.last_refill_timestamp: Dict[str, float] = defaultdict(time_module.time)
+        # Bind the clock once so every operation reads it through a single instance attribute
+        # The monotonic clock never jumps with NTP or manual wall-clock changes, so elapsed times stay non-negative
+        self._now: Callable[[], float] = time_module.monotonic
+        # The wall clock is only read when stats are written, so last_allowed and last_denied stay human-readable
+        self._wall_now: Callable[[], float] = time_module.time
 
-        # Initialize statistics if enabled
-        self.stats: Dict[str, RequestStats] = defaultdict(RequestStats)
-        self.request_history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=stats_window))
+        # Initialize the key limit; when set, the index keeps keys in least to most recently used order
+        self.max_keys = max_keys
 
-        # List of callbacks to execute after each request is processed
-        self.callbacks: List[Callable] = []
+        # Saturation point of the per-key hit counters that protect frequently used keys from eviction
+        self._max_hits = 255
 
-    # Method to allow a request based on rate limiting
-    async def allow_request(self, key: str) -> bool:
-        # If rate is zero, no tokens are available, so immediately raise an HTTPException
-        if self.rate == 0:
-            raise HTTPException(
-                status_code=429,
-                detail="Rate limit exceeded. No tokens available due to zero rate."
-            )
+        # Initialize token buckets and last refill timestamps as parallel columns, indexed by a single key -> row lookup
+        self._idx: Dict[str, int] = OrderedDict() if max_keys else {}
+        self._keys: List[str] = []
+        self._tokens_arr: List[float] = []
+        self._last_arr: List[float] = []
+        self._hits_arr: List[int] = []
 
-        # Get the current time
-        now = time_module.time()
+        # Expose the columns as per-key mappings
+        self.tokens = BucketColumn(self, "_tokens_arr")
+        self.last_refill_timestamp = BucketColumn(self, "_last_arr")
 
-        # If the key is not in the token bucket, initialize it with the maximum capacity plus burst tokens
-        if key not in self.tokens:
-            self.tokens[key] = self.capacity + self.burst
-            self.last_refill_timestamp[key] = now
+        # Initialize statistics if enabled
+        self.stats: Dict[str, RequestStats] = defaultdict(RequestStats)
+        # Each key's request history holds one [second, allowed, denied] bucket per second of the stats window
+        self.request_history: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.stats_window))
+
+        # Running allowed and denied counts for the buckets currently held in each key's request history
+        self._win_allowed: Dict[str, int] = defaultdict(int)
+        self._win_denied: Dict[str, int] = defaultdict(int)
+
+        # Callbacks to execute after each request is processed, in registration order
+        # Each change to the list pairs every callback with whether it is asynchronous, so dispatch does not inspect it on every request
+        # Assigning the list also specializes request processing for the initial configuration
+        self._callbacks: List[Tuple[Callable, bool]] = []
+        self.callbacks = []
+
+    # Method to recompute the values derived from rate, time, capacity and burst after any of them changes
+    def _refresh_limits(self):
+        self._refill_per_sec = self.rate / self.time
+        self._max_tokens = self.capacity + self.burst
+        # Requests arriving less than half a token of refill after the last refill can skip the refill math
+        self._min_refill_interval = 0.5 / self._refill_per_sec
+        self._skip_refill_ceiling = self._max_tokens - 0.5
+
+    # Method to allocate a full bucket row for a new key and return its index
+    def _add_row(self, key: str, now: float) -> int:
+        # Make room for the new key first, so it can never be chosen for eviction itself
+        if self.max_keys and len(self._keys) >= self.max_keys:
+            self._evict_keys(self.max_keys - 1)
+
+        i = self._idx[key] = len(self._keys)
+        self._keys.append(key)
+        self._tokens_arr.append(self._max_tokens)
+        self._last_arr.append(now)
+        self._hits_arr.append(0)
+        return i
+
+    # Method to evict keys until at most `limit` remain, starting from the least recently used one; a key that was hit
+    # since its last pass has its counter halved and is moved to the back instead, so frequently used keys outlive a
+    # flood of one-off keys while each hit buys only a bounded number of passes
+    def _evict_keys(self, limit: int):
+        idx = self._idx
+        hits_arr = self._hits_arr
+        while len(self._keys) > limit:
+            key = next(iter(idx))
+            i = idx[key]
+            if hits_arr[i]:
+                hits_arr[i] >>= 1
+                idx.move_to_end(key)
+                continue
+            self._drop_row(key)
+            # Drop the key's statistics along with its bucket
+            self.stats.pop(key, None)
+            self.request_history.pop(key, None)
+            self._win_allowed.pop(key, None)
+            self._win_denied.pop(key, None)
+
+    # Method to allocate full bucket rows for every key that doesn't have one yet, in a single pass
+    def _bulk_seed(self, keys: Iterable[str]):
+        now = self._now()
+        idx = self._idx
+        new_keys = [key for key in dict.fromkeys(keys) if key not in idx]
+        start = len(self._keys)
+        idx.update(zip(new_keys, range(start, start + len(new_keys))))
+        self._keys.extend(new_keys)
+        self._tokens_arr.extend([self._max_tokens] * len(new_keys))
+        self._last_arr.extend([now] * len(new_keys))
+        self._hits_arr.extend([0] * len(new_keys))
+
+        # Evict keys when over the limit
+        if self.max_keys and len(self._keys) > self.max_keys:
+            self._evict_keys(self.max_keys)
+
+    # Method to take up to `n` tokens from a key's bucket in one step, after bringing its refill up to date
+    def _drain(self, key: str, n: int):
+        now = self._now()
+        i = self._idx.get(key)
+        if i is None:
+            i = self._add_row(key, now)
+
+        # Refill the bucket up to now, then remove the tokens without going below zero
+        elapsed_time = max(0, now - self._last_arr[i])
+        current_tokens = min(self._max_tokens, self._tokens_arr[i] + elapsed_time * self._refill_per_sec)
+        self._tokens_arr[i] = max(0, current_tokens - n)
+        self._last_arr[i] = now
+
+    # Method to remove a key's bucket row, moving the last row into the freed slot to keep the columns dense
+    def _drop_row(self, key: str):
+        i = self._idx.pop(key)
+        last_key = self._keys.pop()
+        tokens = self._tokens_arr.pop()
+        last = self._last_arr.pop()
+        hits = self._hits_arr.pop()
+        if last_key != key:
+            self._idx[last_key] = i
+            self._keys[i] = last_key
+            self._tokens_arr[i] = tokens
+            self._last_arr[i] = last
+            self._hits_arr[i] = hits
+
+    # Method to refill a key's bucket and take one token from it, returning whether it was allowed and the wait time if not
+    def _try_consume(self, key: str, now: float) -> Tuple[bool, float]:
+        # This read-refill-write sequence must never await: the event loop cannot interleave another request
+        # between the read and the write, which is what makes it atomic without a lock or compare-and-swap loop
+
+        # Look up the bucket row for the key, initializing it with the maximum capacity plus burst tokens if missing
+        i = self._idx.get(key)
+        if i is None:
+            i = self._add_row(key, now)
+        elif self.max_keys:
+            # Mark the key as most recently used and count the hit, up to the saturation point
+            self._idx.move_to_end(key)
+            if self._hits_arr[i] < self._max_hits:
+                self._hits_arr[i] += 1
+
+        # Bind the columns locally; comparisons replace the max/min builtin calls on this path
+        tokens_arr = self._tokens_arr
+        last_arr = self._last_arr
 
         # Calculate the elapsed time since the last refill of tokens
-        elapsed_time = max(0, now - self.last_refill_timestamp[key])
+        elapsed_time = now - last_arr[i]
 
-        # Calculate how many tokens to add based on the elapsed time and rate
-        tokens_to_add = elapsed_time * (self.rate / self.time)
+        # If less than half a token has been refilled and the stored tokens already cover the request without nearing
+        # the ceiling, take the token without refilling; the refill timestamp is left untouched so nothing is lost.
+        # Refill timestamps in the future take the full path below, which moves them back to now
+        stored_tokens = tokens_arr[i]
+        if 0 <= elapsed_time < self._min_refill_interval and 1 <= stored_tokens <= self._skip_refill_ceiling:
+            tokens_arr[i] = stored_tokens - 1
+            return True, 0
 
-        # Update the current tokens, making sure it does not exceed the maximum (capacity + burst)
-        current_tokens = min(self.capacity + self.burst, self.tokens[key] + tokens_to_add)
+        # Ignore refill timestamps that lie in the future
+        if elapsed_time < 0:
+            elapsed_time = 0
+
+        # Calculate the current tokens from the elapsed time and rate, making sure it does not exceed the maximum (capacity + burst)
+        current_tokens = stored_tokens + elapsed_time * self._refill_per_sec
+        if current_tokens > self._max_tokens:
+            current_tokens = self._max_tokens
 
         # If there is at least 1 token, allow the request and decrement the token count
         if current_tokens >= 1:
-            self.tokens[key] = current_tokens - 1
-            self.last_refill_timestamp[key] = now
-            request_allowed = True
-        else:
-            # If no tokens are available, disallow the request
-            request_allowed = False
+            tokens_arr[i] = current_tokens - 1
+            last_arr[i] = now
+            return True, 0
 
-        # Update stats for the request, even if the request is denied
-        self.update_stats(key, request_allowed, now)
+        # If no tokens are available, disallow the request and calculate the wait time before the next token
+        return False, (1 - current_tokens) / self._refill_per_sec
 
-        # Trigger any associated callbacks asynchronously
-        await self.trigger_callbacks(request_allowed, key)
+    # Method to allow a request based on rate limiting
+    async def allow_request(self, key: str) -> bool:
+        # Process the request against the key's bucket
+        request_allowed, wait_time = await self._process_request(key)
 
-        # If the request is not allowed, calculate the wait time before the next token is available
+        # If the request is not allowed, raise with the wait time before the next token is available
         if not request_allowed:
-            wait_time = (1 - current_tokens) / (self.rate / self.time)
             # Raise an HTTP exception to indicate that the rate limit has been exceeded
             raise HTTPException(
                 status_code=429,
-                detail=f"Rate limit exceeded. Try again in {wait_time:.2f} seconds."
+                detail=DENIED_DETAIL.format(wait_time)
             )
 
         # Return whether the request was allowed
         return request_allowed
 
+    # Method to check if a request is allowed without raising when it is denied
+    async def try_allow_request(self, key: str) -> bool:
+        request_allowed, _ = await self._process_request(key)
+        return request_allowed
+
+    # Whether request statistics are collected; changing it re-picks the request processing path
+    @property
+    def enable_stats(self) -> bool:
+        return self._enable_stats
+
+    @enable_stats.setter
+    def enable_stats(self, enable_stats: bool):
+        self._enable_stats = enable_stats
+        self._select_process_request()
+
+    # Method to pick the request processing path matching the current stats and callback configuration
+    def _select_process_request(self):
+        if self.enable_stats or self._callbacks:
+            self._process_request = self._process_request_full
+        else:
+            self._process_request = self._process_request_fast
+
+    # Method to process a request when neither stats nor callbacks are active, only consuming a token
+    async def _process_request_fast(self, key: str) -> Tuple[bool, float]:
+        return self._try_consume(key, self._now())
+
+    # Method to allow a batch of requests, returning whether each one was allowed instead of raising
+    async def allow_request_many(self, keys: Iterable[str]) -> List[bool]:
+        # Read the clock once for the whole batch
+        now = self._now()
+        try_consume = self._try_consume
+        results = []
+
+        for key in keys:
+            # Take a token from the key's bucket
+            request_allowed, _ = try_consume(key, now)
+            results.append(request_allowed)
+
+            # Record stats and trigger callbacks like a single request would
+            if self.enable_stats:
+                self.update_stats(key, request_allowed, now)
+            if self._callbacks:
+                await self.trigger_callbacks(request_allowed, key)
+
+        # Return the outcome of each request in order
+        return results
+
+    # Method to process a request for the given key without raising, returning whether it was allowed and the wait time if not
+    async def _process_request_full(self, key: str) -> Tuple[bool, float]:
+        # Get the current time
+        now = self._now()
+
+        # Atomically refill and try to take a token from the key's bucket
+        request_allowed, wait_time = self._try_consume(key, now)
+
+        # Update stats for the request, even if the request is denied
+        self.update_stats(key, request_allowed, now)
+
+        # Trigger any associated callbacks asynchronously, skipping the coroutine entirely when none are registered
+        if self._callbacks:
+            await self.trigger_callbacks(request_allowed, key)
+
+        # Return whether the request was allowed and the wait time before the next token is available
+        return request_allowed, wait_time
+
+    # Method to build the response sent to a client whose request was rate limited
+    def _denied_response(self, wait_time: float) -> Response:
+        return Response(
+            content=DENIED_BODY_PREFIX + b"%.2f" % wait_time + DENIED_BODY_SUFFIX,
+            status_code=429,
+            media_type="application/json"
+        )
+
     # Method to calculate the wait time before the next token is available for the given key
     async def get_wait_time(self, key: str) -> float:
         # Get the current time
-        now = time_module.time()
+        now = self._now()
 
         # If the key doesn't exist in the token bucket, there's no wait time
-        if key not in self.tokens:
+        i = self._idx.get(key)
+        if i is None:
             return 0
 
         # Calculate the elapsed time since the last refill
-        elapsed_time = max(0, now - self.last_refill_timestamp[key])
+        elapsed_time = max(0, now - self._last_arr[i])
 
         # Calculate how many tokens to add based on the elapsed time and rate
-        tokens_to_add = elapsed_time * (self.rate / self.time)
+        tokens_to_add = elapsed_time * self._refill_per_sec
 
         # Update the current tokens, making sure it doesn't exceed the maximum
-        current_tokens = min(self.capacity + self.burst, self.tokens[key] + tokens_to_add)
+        current_tokens = min(self._max_tokens, self._tokens_arr[i] + tokens_to_add)
 
         # If at least 1 token is available, there's no wait time
         if current_tokens >= 1:
@@ -149,7 +409,7 @@ class RateLimiter:
 
         # Calculate the additional tokens required and the time to refill those tokens
         tokens_needed = 1 - current_tokens
-        wait_time = tokens_needed / (self.rate / self.time)
+        wait_time = tokens_needed / self._refill_per_sec
 
         # Return the calculated wait time
         return wait_time
@@ -164,14 +424,43 @@ class RateLimiter:
             # If the request was allowed, increment the allowed count and update the last allowed timestamp
             if allowed:
                 stats.allowed += 1
-                stats.last_allowed = timestamp
+                stats.last_allowed = self._wall_now()
             else:
                 # If the request was denied, increment the denied count and update the last denied timestamp
                 stats.denied += 1
-                stats.last_denied = timestamp
+                stats.last_denied = self._wall_now()
+
+            # Evict the buckets of seconds that fell out of the stats window
+            history = self.request_history[key]
+            second = int(timestamp)
+            self._evict_history(key, history, second - self.stats_window)
+
+            # Count the request in the bucket of the current second, opening a new bucket if needed
+            if history and history[-1][0] == second:
+                bucket = history[-1]
+            else:
+                # Drop the oldest bucket if the history is full so the window counts stay in sync
+                if len(history) == history.maxlen:
+                    self._pop_history(key, history)
+                bucket = [second, 0, 0]
+                history.append(bucket)
+            if allowed:
+                bucket[1] += 1
+                self._win_allowed[key] += 1
+            else:
+                bucket[2] += 1
+                self._win_denied[key] += 1
 
-            # Record the request history by appending the (timestamp, allowed) tuple to the request history list
-            self.request_history[key].append((timestamp, allowed))
+    # Method to drop the oldest bucket from a key's history and remove it from the window counts
+    def _pop_history(self, key: str, history: deque):
+        _, allowed, denied = history.popleft()
+        self._win_allowed[key] -= allowed
+        self._win_denied[key] -= denied
+
+    # Method to drop every bucket at or before the cutoff second from a key's history
+    def _evict_history(self, key: str, history: deque, cutoff: int):
+        while history and history[0][0] <= cutoff:
+            self._pop_history(key, history)
 
     # Implement the get_stats method
     def get_stats(self, key: str) -> Dict:
@@ -179,19 +468,21 @@ class RateLimiter:
         if not self.enable_stats:
             return {"error": "Stats collection is disabled"}
 
-        # Retrieve the stats for the given key
-        stats = self.stats[key]
-        now = time_module.time()
+        # Retrieve the stats for the given key without creating entries for keys that were never seen
+        stats = self.stats.get(key) or RequestStats()
+        now = self._now()
 
-        # Calculate the start of the stats window
-        window_start = now - self.stats_window
+        # Evict the buckets that fell out of the stats window so the running counts only cover the window
+        history = self.request_history.get(key)
+        if history is not None:
+            self._evict_history(key, history, int(now) - self.stats_window)
 
-        # Filter requests that occurred within the stats window
-        window_requests = [request for request in self.request_history[key] if request[0] >= window_start]
+        # Read the allowed and denied requests in the current window from the running counts
+        window_allowed = self._win_allowed.get(key, 0)
+        window_denied = self._win_denied.get(key, 0)
 
-        # Count allowed and denied requests in the current window
-        window_allowed = sum(1 for request in window_requests if request[1])
-        window_denied = len(window_requests) - window_allowed
+        # The last allowed and denied times are wall-clock times, so measure the time since them on the wall clock
+        wall_now = self._wall_now()
 
         # Return the statistics, including total and window-specific data
         return {
@@ -199,44 +490,85 @@ class RateLimiter:
             "total_denied": stats.denied,
             "window_allowed": window_allowed,
             "window_denied": window_denied,
-            "current_tokens": self.tokens[key],
+            "current_tokens": self.tokens.get(key, self._max_tokens),
             "current_capacity": self.capacity,
-            "time_since_last_allowed": now - stats.last_allowed if stats.last_allowed else None,
-            "time_since_last_denied": now - stats.last_denied if stats.last_denied else None,
+            "time_since_last_allowed": wall_now - stats.last_allowed if stats.last_allowed else None,
+            "time_since_last_denied": wall_now - stats.last_denied if stats.last_denied else None,
         }
 
     # Method to reset the state of the rate limiter for a specific key or for all keys
     def reset(self, key: str = None):
         # Get the current time
-        now = time_module.time()
+        now = self._now()
 
         # If a key is provided and it doesn't exist in the token bucket, return without doing anything
         if key:
             # If a specific key is provided, reset tokens and refill timestamp for that key
-            self.tokens[key] = self.capacity + self.burst
-            self.last_refill_timestamp[key] = now
+            i = self._idx.get(key)
+            if i is None:
+                i = self._add_row(key, now)
+            self._tokens_arr[i] = self._max_tokens
+            self._last_arr[i] = now
 
             # If stats tracking is enabled, reset the stats and clear the request history for the key
             if self.enable_stats:
                 self.stats[key] = RequestStats()
                 self.request_history[key].clear()
+                self._win_allowed[key] = 0
+                self._win_denied[key] = 0
         else:
             # If no key is provided, clear all tokens and refill timestamps for all keys
-            self.tokens.clear()
-            self.last_refill_timestamp.clear()
+            self._clear_buckets()
 
             # If stats tracking is enabled, clear all stats and request history
             if self.enable_stats:
-                self.stats.clear()
-                self.request_history.clear()
-
-        # Reinitialize tokens and refill timestamps for the specific key or all keys
-        keys_to_reset = [key] if key else list(self.tokens.keys())
-        
-        # Reset tokens and refill timestamps for the specified keys
-        for k in keys_to_reset:
-            self.tokens[k] = self.capacity + self.burst 
-            self.last_refill_timestamp[k] = now
+                self._clear_stats()
+
+    # Method to clear every key's bucket, stats and request history in place, keeping the configuration and callbacks
+    def reset_all(self):
+        self._clear_buckets()
+        self._clear_stats()
+
+    # Method to empty the key index and every bucket column in place
+    def _clear_buckets(self):
+        self._idx.clear()
+        self._keys.clear()
+        self._tokens_arr.clear()
+        self._last_arr.clear()
+        self._hits_arr.clear()
+
+    # Method to empty every key's stats, request history and window counts in place
+    def _clear_stats(self):
+        self.stats.clear()
+        self.request_history.clear()
+        self._win_allowed.clear()
+        self._win_denied.clear()
+
+    # Method to bring every key's bucket up to date with its pending refill in one pass over the columns
+    def refill_all(self):
+        now = self._now()
+        max_tokens = self._max_tokens
+        refill_per_sec = self._refill_per_sec
+
+        # Refill every key in one pass, ignoring refill timestamps that lie in the future
+        self._tokens_arr[:] = [
+            min(max_tokens, tokens + max(0, now - last) * refill_per_sec)
+            for tokens, last in zip(self._tokens_arr, self._last_arr)
+        ]
+        self._last_arr[:] = [now] * len(self._last_arr)
+
+    # Method to refill every key's bucket at the old refill rate, then scale its tokens for the new rate, in one pass
+    def _rescale_all(self, old_refill: float, scale: float):
+        now = self._now()
+
+        # Hoist the constants shared by every key out of the recalculation
+        max_tokens = self._max_tokens
+
+        self._tokens_arr[:] = [
+            min(max_tokens, min(max_tokens, tokens + (now - last) * old_refill) * scale)
+            for tokens, last in zip(self._tokens_arr, self._last_arr)
+        ]
+        self._last_arr[:] = [now] * len(self._last_arr)
 
     # Method to update the capacity of the token bucket
     def update_capacity(self, new_capacity: int):
@@ -245,18 +577,23 @@ class RateLimiter:
             raise ValueError("The capacity must be greater than zero.")
         # Update the capacity to the new value
         self.capacity = new_capacity
+        self._refresh_limits()
 
     # Method to update the burst size (extra tokens that can be used in addition to the regular capacity)
     def update_burst(self, new_burst: int):
         # Ensure the new burst size is non-negative
         if new_burst < 0:
             raise ValueError("The burst must be greater than or equal to zero.")
+        # Only the extra burst tokens are granted to existing buckets; a smaller burst just lowers the ceiling
+        gained = max(0, new_burst - self.burst)
+
         # Update the burst size to the new value
         self.burst = new_burst
+        self._refresh_limits()
 
-        # For each key, adjust the token count to account for the new burst size
-        for key in self.tokens:
-            self.tokens[key] = min(self.tokens[key] + new_burst, self.capacity + new_burst)
+        # Adjust every key's token count to the new burst size in one pass
+        max_tokens = self._max_tokens
+        self._tokens_arr[:] = [min(tokens + gained, max_tokens) for tokens in self._tokens_arr]
 
     # Method to update the stats window (the time window for tracking statistics)
     def update_stats_window(self, new_stats_window: int):
@@ -268,9 +605,15 @@ class RateLimiter:
 
         # If stats tracking is enabled, resize the request history deque for each key
         if self.enable_stats:
-            for key in self.request_history:
-                # Update the deque to only retain the last `new_stats_window` entries
-                self.request_history[key] = deque(self.request_history[key], maxlen=new_stats_window)
+            for key, history in self.request_history.items():
+                # Skip histories that already have the requested size
+                if history.maxlen == new_stats_window:
+                    continue
+                # Drop the oldest buckets that no longer fit, keeping the window counts in sync without a recount
+                while len(history) > new_stats_window:
+                    self._pop_history(key, history)
+                # Update the deque to only retain the last `new_stats_window` buckets
+                self.request_history[key] = deque(history, maxlen=new_stats_window)
 
     # Method to update the time period over which tokens are refilled
     def update_time(self, seconds: int = 0, minutes: int = 0, hours: int = 0):
@@ -283,18 +626,10 @@ class RateLimiter:
         # Get the old time period
         old_time = self.time
         self.time = new_time
+        self._refresh_limits()
 
-        now = time_module.time()
-
-        # Recalculate the token count for each key based on the new time period
-        for key in self.tokens.keys():
-            elapsed_time = now - self.last_refill_timestamp[key]
-            # Calculate the old tokens, factoring in the old time and rate
-            old_tokens = min(self.capacity + self.burst, self.tokens[key] + elapsed_time * (self.rate / old_time))
-            # Adjust tokens to the new time rate
-            new_tokens = old_tokens * (old_time / new_time)
-            self.tokens[key] = min(self.capacity + self.burst, new_tokens)
-            self.last_refill_timestamp[key] = now
+        # Refill every key at the old time period, then rescale its tokens to the new one
+        self._rescale_all(self.rate / old_time, old_time / new_time)
 
     # Method to update the rate at which tokens are refilled
     def update_rate(self, new_rate: int):
@@ -305,24 +640,17 @@ class RateLimiter:
         # Store the old rate and update the rate to the new value
         old_rate = self.rate
         self.rate = new_rate
+        self._refresh_limits()
 
-        # Get the current time
-        now = time_module.time()
-
-        # Recalculate the token count for each key based on the new rate
-        for key in self.tokens.keys():
-            elapsed_time = now - self.last_refill_timestamp[key]
-            # Calculate the old tokens based on the old rate and elapsed time
-            old_tokens = min(self.capacity + self.burst, self.tokens[key] + elapsed_time * (old_rate / self.time))
-            # Adjust tokens proportionally to the new rate
-            new_tokens = old_tokens * (old_rate / new_rate)
-            self.tokens[key] = min(self.capacity + self.burst, new_tokens)
-            self.last_refill_timestamp[key] = now
+        # Refill every key at the old rate, then rescale its tokens to the new one
+        self._rescale_all(old_rate / self.time, old_rate / new_rate)
 
     # Implement the get_key_from_request method
     def get_key_from_request(self, request: Request) -> str:
         # Return the client's host if available, otherwise return "default"
-        return request.client.host if request.client else "default"
+        # Reading the ASGI scope directly skips building the Address namedtuple behind request.client
+        client = request.scope.get("client")
+        return client[0] if client else "default"
 
     # Implement the enable_stats_collection method
     def enable_stats_collection(self):
@@ -343,21 +671,43 @@ class RateLimiter:
 
     # Implement the trigger_callbacks method
     async def trigger_callbacks(self, allowed: bool, key: str):
-        # Iterate over each registered callback
-        for callback in self.callbacks:
+        # Run each callback in registration order, awaiting the asynchronous ones
+        for callback, is_async in self._callbacks:
             try:
-                # Check if the callback is asynchronous, await if necessary
-                if asyncio.iscoroutinefunction(callback):
+                if is_async:
                     await callback(allowed, key)
                 else:
                     callback(allowed, key)
             except Exception as e:
                 print(f"Error in rate limiter callback: {e}")
 
+    # Callbacks registered on the rate limiter, as a list that can be changed in place
+    @property
+    def callbacks(self) -> List[Callable]:
+        return self._callback_list
+
+    @callbacks.setter
+    def callbacks(self, callbacks: Iterable[Callable]):
+        self._callback_list = CallbackList(self, callbacks)
+        self._classify_callbacks()
+
+    # Method to pair each callback with whether it is asynchronous and pick the matching processing path
+    def _classify_callbacks(self):
+        self._callbacks = [(callback, asyncio.iscoroutinefunction(callback)) for callback in self._callback_list]
+        self._select_process_request()
+
     # Implement the add_callback method
     def add_callback(self, callback: Callable):
-        # Add a new callback function to the list of callbacks
+        # Add a new callback function
         self.callbacks.append(callback)
+
+    # Method to remove a registered callback
+    def remove_callback(self, callback: Callable):
+        self.callbacks.remove(callback)
+
+    # Method to remove every registered callback
+    def clear_callbacks(self):
+        self.callbacks.clear()
     
     # Method to create a rate-limiting decorator for FastAPI routes
     def limit(self):
@@ -366,37 +716,29 @@ class RateLimiter:
             # Asynchronous wrapper function to handle rate-limiting logic
             async def wrapper(request: Request):
                 key = self.get_key_from_request(request)
-                try:
-                    # Try to allow the request based on rate-limiting logic
-                    await self.allow_request(key)
-                    # If allowed, proceed to call the original route handler
-                    return await func(request)
-                except HTTPException as exc:
-                    # If rate-limiting throws an exception, return a JSON response with the error
-                    return JSONResponse(
-                        status_code=exc.status_code,
-                        content={"detail": exc.detail}
-                    )
+                # Try to allow the request based on rate-limiting logic
+                request_allowed, wait_time = await self._process_request(key)
+                # If denied, return the rate limit response directly instead of raising through an exception
+                if not request_allowed:
+                    return self._denied_response(wait_time)
+                # If allowed, proceed to call the original route handler
+                return await func(request)
             return wrapper
         return decorator
 
     # Middleware for FastAPI to apply rate-limiting to all incoming requests
     async def fastapi_middleware(self, request: Request, call_next: Callable):
         key = self.get_key_from_request(request)
-        try:
-            # Try to allow the request based on rate-limiting logic
-            await self.allow_request(key)
-            # If allowed, proceed to the next middleware or route handler
-            response = await call_next(request)
-            # Return the response
-            return response
-        except HTTPException as exc:
-            # If rate-limiting throws an exception, return a JSON response with the error
-            return JSONResponse(
-                status_code=exc.status_code,
-                content={"detail": exc.detail}
-            )
-        
+        # Try to allow the request based on rate-limiting logic
+        request_allowed, wait_time = await self._process_request(key)
+        # If denied, return the rate limit response directly instead of raising through an exception
+        if not request_allowed:
+            return self._denied_response(wait_time)
+        # If allowed, proceed to the next middleware or route handler
+        response = await call_next(request)
+        # Return the response
+        return response
+
 # Implement the setup_rate_limiter function
 def setup_rate_limiter(app: FastAPI, rate_limiter: RateLimiter):
     # Define and attach the rate limiter middleware to the FastAPI app
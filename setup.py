@@ -26,7 +26,8 @@ setup(
             'uvicorn>=0.30.6',
             'httpx>=0.27.2',
             'pytest>=8.3.3',
-            'pytest_asyncio>=0.24.0'
+            'pytest_asyncio>=0.24.0',
+            'pytest-benchmark>=4.0.0'
         ],
     },
     python_requires='>=3.8',
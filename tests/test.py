@@ -2,23 +2,31 @@ from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.testclient import TestClient
 from collections import deque
-import threading
+import itertools
+import dataclasses
 import asyncio
-import uvicorn
 import pytest
+import pytest_asyncio
 import httpx
+import tracemalloc
 import time
-import sys
-import os
-
-# Add the parent directory to the system path
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import the rate limiter and FastAPI integration
 from fastlimiter.fastlimiter import RateLimiter, setup_rate_limiter
 
+# Manually advanced stand-in for time.monotonic, so tests can skip ahead without sleeping
+class FakeClock:
+    def __init__(self, start: float = 1000.0):
+        self.current = start
+
+    def now(self) -> float:
+        return self.current
+
+    def advance(self, seconds: float):
+        self.current += seconds
+
 # Fixtures
-@pytest.fixture
+@pytest.fixture(scope="session")
 def rate_limiter():
     return RateLimiter(
         rate=10,
@@ -29,12 +37,23 @@ def rate_limiter():
         enable_stats=True
     )
 
+# Restore the shared rate limiter before every test, undoing the state and configuration left by the previous one
+@pytest.fixture(autouse=True)
+def clean_rate_limiter(rate_limiter):
+    rate_limiter.reset_all()
+    rate_limiter.update_rate(10)
+    rate_limiter.update_time(seconds=60)
+    rate_limiter.update_capacity(10)
+    rate_limiter.update_burst(5)
+    rate_limiter.update_stats_window(20)
+    rate_limiter.enable_stats_collection()
+    rate_limiter.clear_callbacks()
+    yield
+
 # Fixtures for FastAPI integration
 @pytest.fixture
-def app(rate_limiter):
-    app = FastAPI()
-    
-    rate_limiter_limited = RateLimiter(
+def rate_limiter_limited():
+    return RateLimiter(
         rate=10,
         seconds=60,
         capacity=10,
@@ -43,6 +62,10 @@ def app(rate_limiter):
         enable_stats=True
     )
 
+@pytest.fixture
+def app(rate_limiter, rate_limiter_limited):
+    app = FastAPI()
+
     setup_rate_limiter(app, rate_limiter)
 
     @app.get("/test")
@@ -65,10 +88,27 @@ def app(rate_limiter):
 
 @pytest.fixture
 def client(app):
-    return TestClient(app)
+    # Entering the client keeps one blocking portal, and its event loop thread, alive for every request of the test
+    with TestClient(app) as client:
+        yield client
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def async_client(app):
+    # Serve the app in-process on the test's event loop, reporting the same client host as TestClient
+    transport = httpx.ASGITransport(app=app, client=("testclient", 50000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        yield client
+
+@pytest.fixture
+def fake_clock(rate_limiter):
+    clock = FakeClock()
+    real_now = rate_limiter._now
+    rate_limiter._now = clock.now
+    yield clock
+    rate_limiter._now = real_now
 
 # ------- Basic functionality tests ------- #
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_invalid_rate(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=0, seconds=60)
@@ -76,7 +116,7 @@ async def test_invalid_rate(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=-1, seconds=60)
         
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_invalid_capacity(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=5, capacity=0, seconds=60)
@@ -84,61 +124,61 @@ async def test_invalid_capacity(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=5, capacity=-1, seconds=60)
         
-@pytest.mark.asyncio
-async def test_invalid_rate_time(rate_limiter):
-    invalid_cases = [
-        {"rate": 5, "seconds": 0, "minutes": 0, "hours": 0},        # No time provided
-
-        {"rate": 5, "seconds": 0},                                  # 0 seconds
-        {"rate": 5, "seconds": -1},                                 # -1 second
-        {"rate": 5, "minutes": 0},                                  # 0 minutes
-        {"rate": 5, "minutes": -1},                                 # -1 minute
-        {"rate": 5, "hours": 0},                                    # 0 hours
-        {"rate": 5, "hours": -1},                                   # -1 hour
-
-        {"rate": 5, "seconds": -30, "minutes": 0, "hours": 0},      # Total = -30 seconds
-        {"rate": 5, "seconds": 0, "minutes": -1, "hours": 0},       # Total = -1 minute
-        {"rate": 5, "seconds": 0, "minutes": 0, "hours": -1},       # Total = -1 hour
-        {"rate": 5, "seconds": 3600, "hours": -1},                  # Total = 0 (1 hour - 1 hour)
-        {"rate": 5, "minutes": 120, "hours": -2},                   # Total = 0 (2 hours - 2 hours)
-        {"rate": 5, "seconds": 1800, "hours": -1},                  # Total = -30 minutes (1 hour - 30 min)
-        {"rate": 5, "seconds": 0, "minutes": -120, "hours": 2},     # Total = 0 (2 hours - 2 hours)
-        {"rate": 5, "seconds": -120, "minutes": 2},                 # Total = 0 (2 min - 2 min)
-        {"rate": 5, "seconds": -120, "minutes": 1, "hours": 0},     # Total = -1 minute (2 min - 2 min)
-        {"rate": 5, "seconds": -3600, "minutes": 59, "hours": 0},   # Total = -1 minutes
-        {"rate": 5, "seconds": 30, "minutes": -1, "hours": 0},      # Total = -30 seconds
-    ]
-    
-    for case in invalid_cases:
-        with pytest.raises(ValueError):
-            RateLimiter(**case)
-    
-@pytest.mark.asyncio
-async def test_valid_rate_time(rate_limiter):
-    valid_cases = [
-        {"rate": 5, "seconds": 30},                                 # Total = 30 seconds
-        {"rate": 5, "minutes": 1},                                  # Total = 1 minute
-        {"rate": 5, "hours": 1},                                    # Total = 1 hour
-        
-        {"rate": 5, "seconds": 30, "minutes": 1},                   # Total = 1 min 30 seconds
-        {"rate": 5, "minutes": 1, "hours": 1},                      # Total = 1 hour 1 minute
-        {"rate": 5, "seconds": 3600, "hours": 1},                   # Total = 2 hours
-        
-        {"rate": 5, "minutes": -1, "seconds": 120},                 # Total = 1 minute (2 min - 1 min)
-        {"rate": 5, "hours": -1, "seconds": 7200},                  # Total = 1 hour (2 hours - 1 hour)
-        {"rate": 5, "minutes": -30, "hours": 2},                    # Total = 1 hour 30 minutes
-        {"rate": 5, "seconds": -120, "minutes": 3},                 # Total = 1 minute (3 min - 2 min)
-        {"rate": 5, "hours": -1, "minutes": 90},                    # Total = 30 minutes (1.5 hours - 1 hour)
-        {"rate": 5, "seconds": 300, "minutes": -5, "hours": 1},     # Total = 1 hour (1 hour + 5 min - 5 min)
-    ]
-    
-    for case in valid_cases:
-        try:
-            RateLimiter(**case)
-        except ValueError:
-            pytest.fail(f"RateLimiter raised ValueError unexpectedly for case: {case}")
-            
-@pytest.mark.asyncio
+INVALID_RATE_TIME_CASES = [
+    {"rate": 5, "seconds": 0, "minutes": 0, "hours": 0},        # No time provided
+
+    {"rate": 5, "seconds": 0},                                  # 0 seconds
+    {"rate": 5, "seconds": -1},                                 # -1 second
+    {"rate": 5, "minutes": 0},                                  # 0 minutes
+    {"rate": 5, "minutes": -1},                                 # -1 minute
+    {"rate": 5, "hours": 0},                                    # 0 hours
+    {"rate": 5, "hours": -1},                                   # -1 hour
+
+    {"rate": 5, "seconds": -30, "minutes": 0, "hours": 0},      # Total = -30 seconds
+    {"rate": 5, "seconds": 0, "minutes": -1, "hours": 0},       # Total = -1 minute
+    {"rate": 5, "seconds": 0, "minutes": 0, "hours": -1},       # Total = -1 hour
+    {"rate": 5, "seconds": 3600, "hours": -1},                  # Total = 0 (1 hour - 1 hour)
+    {"rate": 5, "minutes": 120, "hours": -2},                   # Total = 0 (2 hours - 2 hours)
+    {"rate": 5, "seconds": 1800, "hours": -1},                  # Total = -30 minutes (1 hour - 30 min)
+    {"rate": 5, "seconds": 0, "minutes": -120, "hours": 2},     # Total = 0 (2 hours - 2 hours)
+    {"rate": 5, "seconds": -120, "minutes": 2},                 # Total = 0 (2 min - 2 min)
+    {"rate": 5, "seconds": -120, "minutes": 1, "hours": 0},     # Total = -1 minute (2 min - 2 min)
+    {"rate": 5, "seconds": -3600, "minutes": 59, "hours": 0},   # Total = -1 minutes
+    {"rate": 5, "seconds": 30, "minutes": -1, "hours": 0},      # Total = -30 seconds
+]
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize("case", INVALID_RATE_TIME_CASES, ids=repr)
+async def test_invalid_rate_time(rate_limiter, case):
+    with pytest.raises(ValueError):
+        RateLimiter(**case)
+
+VALID_RATE_TIME_CASES = [
+    {"rate": 5, "seconds": 30},                                 # Total = 30 seconds
+    {"rate": 5, "minutes": 1},                                  # Total = 1 minute
+    {"rate": 5, "hours": 1},                                    # Total = 1 hour
+    
+    {"rate": 5, "seconds": 30, "minutes": 1},                   # Total = 1 min 30 seconds
+    {"rate": 5, "minutes": 1, "hours": 1},                      # Total = 1 hour 1 minute
+    {"rate": 5, "seconds": 3600, "hours": 1},                   # Total = 2 hours
+    
+    {"rate": 5, "minutes": -1, "seconds": 120},                 # Total = 1 minute (2 min - 1 min)
+    {"rate": 5, "hours": -1, "seconds": 7200},                  # Total = 1 hour (2 hours - 1 hour)
+    {"rate": 5, "minutes": -30, "hours": 2},                    # Total = 1 hour 30 minutes
+    {"rate": 5, "seconds": -120, "minutes": 3},                 # Total = 1 minute (3 min - 2 min)
+    {"rate": 5, "hours": -1, "minutes": 90},                    # Total = 30 minutes (1.5 hours - 1 hour)
+    {"rate": 5, "seconds": 300, "minutes": -5, "hours": 1},     # Total = 1 hour (1 hour + 5 min - 5 min)
+]
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize("case", VALID_RATE_TIME_CASES, ids=repr)
+async def test_valid_rate_time(rate_limiter, case):
+    try:
+        RateLimiter(**case)
+    except ValueError:
+        pytest.fail(f"RateLimiter raised ValueError unexpectedly for case: {case}")
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_multiple_time_units(rate_limiter):
     previous_rate = rate_limiter.rate
     previous_burst = rate_limiter.burst
@@ -157,7 +197,6 @@ async def test_multiple_time_units(rate_limiter):
 
     for _ in range(60):
         await rate_limiter.allow_request(key)
-        print(f"Tokens after request {_ + 1}: {rate_limiter.tokens[key]}")
 
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
@@ -167,12 +206,12 @@ async def test_multiple_time_units(rate_limiter):
     rate_limiter.update_capacity(previous_capacity)
     rate_limiter.update_time(seconds=previous_time)
         
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_invalid_burst(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=5, seconds=60, burst=-1)
         
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_invalid_stats_window(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=5, seconds=60, stats_window=0)
@@ -180,41 +219,33 @@ async def test_invalid_stats_window(rate_limiter):
     with pytest.raises(ValueError):
         RateLimiter(rate=5, seconds=60, stats_window=-1)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_basic_rate_limiting(rate_limiter):
     key = "test_user"
     allowed_count = 0
     for i in range(15):
-        try:
-            _ = await rate_limiter.allow_request(key)
+        if await rate_limiter.try_allow_request(key):
             allowed_count += 1
-            print(f"Request {i+1}: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
     
     assert allowed_count == 15, f"Expected 15 allowed requests, got {allowed_count}"
     
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_burst_capacity(rate_limiter):
     key = "test_user"
     allowed_count = 0
     for i in range(15):
-        try:
-            _ = await rate_limiter.allow_request(key)
+        if await rate_limiter.try_allow_request(key):
             allowed_count += 1
-            print(f"Request {i+1}: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
     
     assert allowed_count == 15, f"Expected 15 allowed requests (10 regular + 5 burst), got {allowed_count}"
     
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_edge_case_dynamic_updates(rate_limiter):
     key = "test_user"
 
@@ -228,12 +259,8 @@ async def test_edge_case_dynamic_updates(rate_limiter):
     rate_limiter.reset(key)
 
     requests_made = 0
-    try:
-        while True:
-            await rate_limiter.allow_request(key)
-            requests_made += 1
-    except HTTPException:
-        pass
+    while await rate_limiter.try_allow_request(key):
+        requests_made += 1
 
     rate_limiter.update_rate(previous_rate)
     rate_limiter.update_burst(previous_burst)
@@ -241,7 +268,7 @@ async def test_edge_case_dynamic_updates(rate_limiter):
 
     assert requests_made == 1000, f"Expected exactly 1000 requests, got {requests_made}"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_consistency_across_resets(rate_limiter):
     key = "test_user"
     
@@ -257,7 +284,25 @@ async def test_consistency_across_resets(rate_limiter):
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
+async def test_reset_all(rate_limiter):
+    callback_results = []
+    rate_limiter.add_callback(lambda allowed, key: callback_results.append(allowed))
+
+    await rate_limiter.allow_request("user1")
+    await rate_limiter.allow_request("user2")
+    rate_limiter.disable_stats_collection()
+
+    rate_limiter.reset_all()
+
+    assert len(rate_limiter.tokens) == 0, "All buckets should be cleared"
+    assert not rate_limiter.stats and not rate_limiter.request_history, "Stats should be cleared even while collection is disabled"
+
+    await rate_limiter.allow_request("user1")
+    assert rate_limiter.tokens["user1"] == pytest.approx(14, abs=0.01), "Keys should start over with a full bucket"
+    assert callback_results == [True, True, True], "Callbacks should survive reset_all"
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_behavior_near_capacity_limits(rate_limiter):
     key = "test_user"
     
@@ -269,57 +314,58 @@ async def test_behavior_near_capacity_limits(rate_limiter):
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_stats_collection(rate_limiter):
     key = "test_user"
     for i in range(15):
-        try:
-            await rate_limiter.allow_request(key)
-            print(f"Request {i+1}: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key)
 
     stats = rate_limiter.get_stats(key)
-    print(f"Stats: {stats}")
     assert stats["total_allowed"] == 15, f"Expected 15 allowed requests, got {stats['total_allowed']}"
     assert stats["total_denied"] == 0, f"Expected 0 denied requests, got {stats['total_denied']}"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stats_last_times_are_wall_clock(rate_limiter, fake_clock):
+    key = "test_user"
+    before = time.time()
+    await rate_limiter.try_allow_request(key)
+    after = time.time()
+
+    last_allowed = rate_limiter.stats[key].last_allowed
+    assert before <= last_allowed <= after, f"last_allowed should be a wall-clock time, got {last_allowed}"
+    assert rate_limiter.get_stats(key)["time_since_last_allowed"] >= 0, "Time since the last allowed request should not be negative"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_request_stats_is_dataclass(rate_limiter):
+    key = "test_user"
+    await rate_limiter.try_allow_request(key)
+
+    stats = dataclasses.asdict(rate_limiter.stats[key])
+    assert stats["allowed"] == 1 and stats["denied"] == 0, f"RequestStats should convert with dataclasses.asdict, got {stats}"
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_reset_functionality(rate_limiter):
     key = "test_user"
     for i in range(15):
-        try:
-            await rate_limiter.allow_request(key)
-            print(f"Request {i+1}: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key)
     
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
     
     rate_limiter.reset(key)
-    print("Rate limiter reset")
     
     result = await rate_limiter.allow_request(key)
     assert result, "Request should be allowed after reset"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_multiple_keys(rate_limiter):
     key1 = "user1"
     key2 = "user2"
     
     for i in range(15):
-        try:
-            _ = await rate_limiter.allow_request(key1)
-            print(f"Request {i+1} for key1: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1} for key1: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key1)
         
-        try:
-            _ = await rate_limiter.allow_request(key2)
-            print(f"Request {i+1} for key2: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1} for key2: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key2)
     
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key1)
@@ -327,130 +373,181 @@ async def test_multiple_keys(rate_limiter):
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key2)
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_get_wait_time(rate_limiter):
     key = "test_user"
     for i in range(15):
-        try:
-            await rate_limiter.allow_request(key)
-            print(f"Request {i+1}: Allowed")
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key)
     
     wait_time = await rate_limiter.get_wait_time(key)
-    print(f"Wait time: {wait_time}")
     assert wait_time > 0, f"Wait time should be greater than 0 after exceeding limit, got {wait_time}"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
+async def test_unknown_key_queries_do_not_create_state(rate_limiter):
+    key = "never_seen"
+
+    wait_time = await rate_limiter.get_wait_time(key)
+    stats = rate_limiter.get_stats(key)
+
+    assert wait_time == 0, f"Unknown key should have no wait time, got {wait_time}"
+    assert stats["total_allowed"] == 0 and stats["window_allowed"] == 0, "Unknown key should report empty stats"
+    assert key not in rate_limiter.tokens, "get_wait_time should not create a bucket for an unknown key"
+    assert key not in rate_limiter.stats, "get_stats should not create stats for an unknown key"
+    assert key not in rate_limiter.request_history, "get_stats should not create a history for an unknown key"
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_disable_enable_stats(rate_limiter):
     key = "test_user"
     await rate_limiter.allow_request(key)
     
     stats = rate_limiter.get_stats(key)
-    print(f"Initial stats: {stats}")
     assert stats is not None, "Stats should be available"
     
     rate_limiter.disable_stats_collection()
     disabled_stats = rate_limiter.get_stats(key)
-    print(f"Disabled stats: {disabled_stats}")
     assert disabled_stats == {"error": "Stats collection is disabled"}, "Stats should be disabled"
     
     rate_limiter.enable_stats_collection()
     await rate_limiter.allow_request(key)
     enabled_stats = rate_limiter.get_stats(key)
-    print(f"Enabled stats: {enabled_stats}")
     assert enabled_stats is not None, "Stats should be available after re-enabling"
     
-@pytest.mark.asyncio
-async def test_rate_limiter_refill(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_rate_limiter_refill(rate_limiter, fake_clock):
     key = "test_user"
     
     for _ in range(10):
         await rate_limiter.allow_request(key)
 
-    await asyncio.sleep(5)
+    fake_clock.advance(5)
+    await asyncio.sleep(0)
     
     allowed_count = 0
     for _ in range(5):
-        try:
-            await rate_limiter.allow_request(key)
+        if await rate_limiter.try_allow_request(key):
             allowed_count += 1
-        except HTTPException:
-            pass
     
     assert allowed_count > 0, "Requests should be allowed after token refill"
 
+@pytest.mark.asyncio(loop_scope="session")
+async def test_clustered_requests_keep_pending_refill(rate_limiter):
+    key = "test_user"
+
+    for _ in range(5):
+        await rate_limiter.allow_request(key)
+
+    rate_limiter.last_refill_timestamp[key] -= 2
+    await rate_limiter.allow_request(key)
+    assert rate_limiter.tokens[key] == pytest.approx(9, abs=0.01), "A request within half a token of refill should only take a token"
+
+    rate_limiter.last_refill_timestamp[key] -= 2
+    await rate_limiter.allow_request(key)
+    assert rate_limiter.tokens[key] == pytest.approx(8 + 4 / 6, abs=0.01), "Refill accumulated across skipped requests should not be lost"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bucket_row_removal(rate_limiter):
+    for key in ("user1", "user2", "user3"):
+        await rate_limiter.allow_request(key)
+
+    for _ in range(4):
+        await rate_limiter.allow_request("user3")
+
+    del rate_limiter.tokens["user1"]
+
+    assert "user1" not in rate_limiter.tokens, "Removed key should no longer have a bucket"
+    assert len(rate_limiter.tokens) == 2, f"Expected 2 buckets, got {len(rate_limiter.tokens)}"
+    assert rate_limiter.tokens["user2"] == pytest.approx(14, abs=0.01), "user2 bucket should be unaffected by the removal"
+    assert rate_limiter.tokens["user3"] == pytest.approx(10, abs=0.01), "user3 bucket should survive being moved into the freed row"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bucket_columns_stay_aligned(rate_limiter):
+    for key in ("user1", "user2", "user3"):
+        await rate_limiter.allow_request(key)
+
+    rate_limiter.tokens["user4"] = 3
+    del rate_limiter.tokens["user2"]
+    rate_limiter.reset("user5")
+
+    rate_limiter.update_rate(20)
+    rate_limiter.update_time(seconds=30)
+
+    assert set(rate_limiter.tokens) == {"user1", "user3", "user4", "user5"}, "Updates should not add or drop keys"
+    assert set(rate_limiter.tokens) == set(rate_limiter.last_refill_timestamp), "Tokens and refill timestamps should cover the same keys"
+    assert len(set(rate_limiter.last_refill_timestamp.values())) == 1, "Every bucket should share the refill time of the last update"
+
 # ------- FastAPI integration tests ------- #
-def test_middleware_rate_limiting(client):
-    for i in range(15):
-        response = client.get("/test")
+@pytest.mark.asyncio(loop_scope="session")
+async def test_middleware_rate_limiting(async_client):
+    responses = await asyncio.gather(*[async_client.get("/test") for _ in range(15)])
+    for i, response in enumerate(responses):
         assert response.status_code == 200, f"Request {i+1} should be allowed"
 
-    response = client.get("/test")
+    response = await async_client.get("/test")
     assert response.status_code == 429, "Request should be rate limited"
     assert "Rate limit exceeded" in response.json()["detail"]
 
-@pytest.mark.asyncio
-async def test_decorator_rate_limiting(client, rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_decorator_rate_limiting(client, rate_limiter, rate_limiter_limited, fake_clock):
     key = "testclient"
 
+    # Drive the decorator's limiter from the same fake clock as the middleware's
+    rate_limiter_limited._now = fake_clock.now
     rate_limiter.reset(key)
 
     for i in range(15):
         response = client.get("/limited")
         assert response.status_code == 200, f"Request {i+1} should be allowed. Content: {response.json()}"
-        await asyncio.sleep(0.1)
+        fake_clock.advance(0.1)
+        await asyncio.sleep(0)
 
+    # Refill the middleware's bucket so the decorator's limiter is the one that has to deny the next request
+    rate_limiter.reset(key)
     response = client.get("/limited")
 
     assert response.status_code == 429, f"Request 16 should be rate-limited, but got {response.status_code}"
+    assert rate_limiter_limited.get_stats(key)["total_denied"] == 1, "The decorator's limiter should have denied request 16"
 
-def test_different_endpoints(client):
-    for _ in range(15):
-        client.get("/test")
-
-    for _ in range(7):
-        client.get("/limited")
+@pytest.mark.asyncio(loop_scope="session")
+async def test_different_endpoints(async_client):
+    await asyncio.gather(*[async_client.get("/test") for _ in range(15)])
+    await asyncio.gather(*[async_client.get("/limited") for _ in range(7)])
 
-    response = client.get("/test")
+    response = await async_client.get("/test")
     assert response.status_code == 429, "/test should be rate limited"
 
-    response = client.get("/limited")
+    response = await async_client.get("/limited")
     assert response.status_code == 429, "/limited should be rate limited"
 
-def test_rate_limit_reset(client, rate_limiter):
-    for _ in range(15):
-        client.get("/test")
+@pytest.mark.asyncio(loop_scope="session")
+async def test_rate_limit_reset(async_client, rate_limiter):
+    await asyncio.gather(*[async_client.get("/test") for _ in range(15)])
 
-    response = client.get("/test")
+    response = await async_client.get("/test")
     assert response.status_code == 429, "Request should be rate limited"
 
     rate_limiter.reset("testclient")
 
-    response = client.get("/test")
+    response = await async_client.get("/test")
     assert response.status_code == 200, "Request should be allowed after reset"
     
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_rate_limiter_with_multiple_clients(rate_limiter):
     async def make_request(client_id):
-        try:
-            _ = await rate_limiter.allow_request(client_id)
-            print(f"Request for {client_id}: Allowed")
-        except HTTPException as e:
-            print(f"Request for {client_id}: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(client_id)
 
     clients = ["client_1", "client_2", "client_3", "client_4", "client_5"]
     
-    for _ in range(16):
-        tasks = [make_request(client) for client in clients]
-        await asyncio.gather(*tasks)
+    # Keys never contend, so every round for every client can run in a single gather
+    tasks = [make_request(client) for _ in range(16) for client in clients]
+    await asyncio.gather(*tasks)
 
     for client in clients:
+        assert rate_limiter.get_stats(client)["total_allowed"] == 15, f"Expected 15 allowed requests for {client}"
         with pytest.raises(HTTPException):
             await rate_limiter.allow_request(client)
 
-@pytest.mark.asyncio
-async def test_stats_window_tracking(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stats_window_tracking(rate_limiter, fake_clock):
     key = "test_user"
     
     for _ in range(5):
@@ -459,12 +556,41 @@ async def test_stats_window_tracking(rate_limiter):
     stats = rate_limiter.get_stats(key)
     assert stats["window_allowed"] == 5, "Stats should track 5 allowed requests in the window"
     
-    await asyncio.sleep(rate_limiter.stats_window)
+    fake_clock.advance(rate_limiter.stats_window + 0.01)
+    await asyncio.sleep(0)
     
     stats = rate_limiter.get_stats(key)
     assert stats["window_allowed"] == 0, "Stats window should reset after elapsed time"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stats_window_buckets_per_second(rate_limiter, fake_clock):
+    key = "test_user"
+
+    for _ in range(3):
+        await rate_limiter.allow_request(key)
+    fake_clock.advance(10)
+    for _ in range(2):
+        await rate_limiter.allow_request(key)
+
+    assert len(rate_limiter.request_history[key]) == 2, "Requests within the same second should share a bucket"
+
+    fake_clock.advance(10)
+    stats = rate_limiter.get_stats(key)
+    assert stats["window_allowed"] == 2, f"Only the first second should have left the window, got {stats['window_allowed']}"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stats_window_counts_denied(rate_limiter):
+    key = "test_user"
+    rate_limiter.update_stats_window(60)
+
+    for _ in range(18):
+        await rate_limiter.try_allow_request(key)
+
+    stats = rate_limiter.get_stats(key)
+    assert stats["window_allowed"] == 15, f"Expected 15 allowed requests in the window, got {stats['window_allowed']}"
+    assert stats["window_denied"] == 3, f"Expected 3 denied requests in the window, got {stats['window_denied']}"
     
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_stats_cleared_on_reset(rate_limiter):
     key = "test_user"
     
@@ -477,25 +603,120 @@ async def test_stats_cleared_on_reset(rate_limiter):
     assert stats["total_allowed"] == 0, "Total allowed requests should be reset to 0"
     assert stats["total_denied"] == 0, "Total denied requests should be reset to 0"
     
-@pytest.mark.asyncio
-async def test_cleanup_of_unused_keys(rate_limiter):
-    for i in range(10000):
-        key = f"unique_key_{i}"
-        await rate_limiter.allow_request(key)
-    
-    import sys
-    memory_usage = sys.getsizeof(rate_limiter.tokens) + sys.getsizeof(rate_limiter.last_refill_timestamp)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_cleanup_of_unused_keys():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, burst=5, max_keys=1000)
+    keys = [f"unique_key_{i}" for i in range(10000)]
+
+    tracemalloc.start()
+    try:
+        snapshot_before = tracemalloc.take_snapshot()
+        rate_limiter._bulk_seed(keys)
+        snapshot_after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    assert len(rate_limiter.tokens) == 1000, f"Expected 1000 tracked keys, got {len(rate_limiter.tokens)}"
+    memory_usage = sum(stat.size_diff for stat in snapshot_after.compare_to(snapshot_before, 'lineno'))
     assert memory_usage < 1000000, "Memory usage too high, unused keys may not be cleaned up"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
+async def test_least_recently_used_key_eviction():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, burst=5, max_keys=2)
+
+    await rate_limiter.allow_request("user1")
+    await rate_limiter.allow_request("user2")
+    await rate_limiter.allow_request("user1")
+    await rate_limiter.allow_request("user3")
+
+    assert set(rate_limiter.tokens) == {"user1", "user3"}, "The least recently used key should have been evicted"
+    assert "user2" not in rate_limiter.stats and "user2" not in rate_limiter.request_history, "Evicted keys should drop their statistics"
+    assert rate_limiter.tokens["user1"] == pytest.approx(13, abs=0.01), "Surviving keys should keep their bucket"
+    assert rate_limiter.tokens["user3"] == pytest.approx(14, abs=0.01), "The new key should own its bucket after eviction"
+
+    with pytest.raises(ValueError):
+        RateLimiter(rate=10, seconds=60, max_keys=0)
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_frequently_used_key_survives_eviction():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, burst=5, max_keys=2)
+
+    for _ in range(3):
+        await rate_limiter.allow_request("hot_user")
+
+    for i in range(3):
+        await rate_limiter.allow_request(f"one_off_{i}")
+
+    assert "hot_user" in rate_limiter.tokens, "A frequently used key should outlive a flood of one-off keys"
+    assert rate_limiter.tokens["hot_user"] == pytest.approx(12, abs=0.01), "The surviving key should keep its bucket"
+    assert len(rate_limiter.tokens) == 2, f"Expected 2 tracked keys, got {len(rate_limiter.tokens)}"
+
+    await rate_limiter.allow_request("one_off_3")
+    assert "hot_user" not in rate_limiter.tokens, "Passes granted by past hits should run out once the key goes idle"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_try_allow_request(rate_limiter):
+    results = [await rate_limiter.try_allow_request("user1") for _ in range(16)]
+
+    assert results == [True] * 15 + [False], f"Expected 15 allowed and 1 denied, got {results}"
+    assert rate_limiter.get_stats("user1")["total_denied"] == 1, "Denied requests should be recorded in stats"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_allow_request_many(rate_limiter):
+    results = await rate_limiter.allow_request_many(["user1"] * 16 + ["user2"])
+
+    assert results == [True] * 15 + [False, True], f"Expected 15 allowed, 1 denied and 1 allowed, got {results}"
+
+    stats = rate_limiter.get_stats("user1")
+    assert stats["total_allowed"] == 15 and stats["total_denied"] == 1, "Batched requests should be recorded in stats"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_drain(rate_limiter, fake_clock):
+    await rate_limiter.allow_request("user1")
+    fake_clock.advance(6)
+
+    rate_limiter._drain("user1", 10)
+    assert rate_limiter.tokens["user1"] == pytest.approx(5, abs=0.01), "Draining should apply the pending refill first"
+
+    rate_limiter._drain("user1", 10)
+    assert rate_limiter.tokens["user1"] == 0, "Draining should never go below zero"
+    assert rate_limiter.get_stats("user1")["total_allowed"] == 1, "Draining should not be recorded as requests"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_refill_all(rate_limiter, fake_clock):
+    for _ in range(15):
+        await rate_limiter.allow_request("user1")
+    for _ in range(5):
+        await rate_limiter.allow_request("user2")
+
+    fake_clock.advance(30)
+    rate_limiter.refill_all()
+
+    assert rate_limiter.tokens["user1"] == pytest.approx(5, abs=0.01), f"Expected 5 refilled tokens, got {rate_limiter.tokens['user1']}"
+    assert rate_limiter.tokens["user2"] == pytest.approx(15, abs=0.01), "Refilled tokens should be capped at capacity plus burst"
+    assert rate_limiter.last_refill_timestamp["user1"] == fake_clock.now(), "Refill timestamps should move to now"
+
+    for _ in range(5):
+        await rate_limiter.allow_request("user1")
+    with pytest.raises(HTTPException):
+        await rate_limiter.allow_request("user1")
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_bulk_seed(rate_limiter):
+    await rate_limiter.allow_request("existing")
+
+    rate_limiter._bulk_seed(["existing", "seeded_1", "seeded_2", "seeded_1"])
+
+    assert len(rate_limiter.tokens) == 3, f"Expected 3 buckets, got {len(rate_limiter.tokens)}"
+    assert rate_limiter.tokens["existing"] == pytest.approx(14, abs=0.01), "Seeding should not refill existing buckets"
+    assert rate_limiter.tokens["seeded_2"] == 15, "Seeded buckets should start full"
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_concurrent_updates(rate_limiter):
     key = "test_user"
     
     async def make_request_and_update():
-        try:
-            await rate_limiter.allow_request(key)
-        except HTTPException:
-            pass
+        await rate_limiter.try_allow_request(key)
         rate_limiter.update_rate(rate_limiter.rate + 1)
     
     tasks = [make_request_and_update() for _ in range(100)]
@@ -503,8 +724,8 @@ async def test_concurrent_updates(rate_limiter):
     
     assert rate_limiter.rate == 110, "Rate should have been updated 100 times"
 
-@pytest.mark.asyncio
-async def test_time_shift_handling(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_time_shift_handling(rate_limiter, fake_clock):
     key = "test_user"
 
     for _ in range(10):
@@ -518,7 +739,12 @@ async def test_time_shift_handling(rate_limiter):
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
 
-@pytest.mark.asyncio
+    fake_clock.advance(rate_limiter.time)
+
+    assert await rate_limiter.try_allow_request(key), "A refill timestamp in the future should not lock the key out past one period"
+    assert rate_limiter.tokens[key] == pytest.approx(9, abs=0.01), f"Expected 9 tokens after a full period, got {rate_limiter.tokens[key]}"
+
+@pytest.mark.asyncio(loop_scope="session")
 async def test_stats_collection_during_rate_changes(rate_limiter):
     key = "test_user"
     
@@ -528,15 +754,12 @@ async def test_stats_collection_during_rate_changes(rate_limiter):
     rate_limiter.update_rate(5)
     
     for _ in range(5):
-        try:
-            await rate_limiter.allow_request(key)
-        except HTTPException:
-            pass
+        await rate_limiter.try_allow_request(key)
     
     stats = rate_limiter.get_stats(key)
     assert stats["total_allowed"] == 15, "Stats should account for requests before and after rate change"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_multiple_stats_collection_toggles(rate_limiter):
     key = "test_user"
     
@@ -574,7 +797,7 @@ async def test_multiple_stats_collection_toggles(rate_limiter):
     rate_limiter.update_capacity(previous_capacity)
     assert final_stats["total_allowed"] == 10, "Final stats should still show 10 allowed requests"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_callback_execution(rate_limiter):
     key = "test_user"
     callback_results = []
@@ -602,53 +825,124 @@ async def test_callback_execution(rate_limiter):
     assert ("sync", False, key) in callback_results, "Sync callback should be called for denied request"
     assert ("async", False, key) in callback_results, "Async callback should be called for denied request"
 
+@pytest.mark.asyncio(loop_scope="session")
+async def test_callbacks_run_in_registration_order():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, enable_stats=False)
+    callback_results = []
+
+    async def async_callback(allowed, key):
+        callback_results.append("async1")
+
+    def sync_callback(allowed, key):
+        callback_results.append("sync2")
+
+    rate_limiter.add_callback(async_callback)
+    rate_limiter.add_callback(sync_callback)
+    await rate_limiter.allow_request("test_user")
+
+    assert callback_results == ["async1", "sync2"], f"Callbacks should run in registration order, got {callback_results}"
+    assert rate_limiter.callbacks == [async_callback, sync_callback], "callbacks should list the registered callbacks"
+
+    rate_limiter.remove_callback(async_callback)
+    await rate_limiter.allow_request("test_user")
+
+    assert callback_results == ["async1", "sync2", "sync2"], "A removed callback should no longer run"
+
+    rate_limiter.clear_callbacks()
+    await rate_limiter.allow_request("test_user")
+
+    assert callback_results == ["async1", "sync2", "sync2"], "Cleared callbacks should no longer run"
+    assert rate_limiter._process_request == rate_limiter._process_request_fast, "Clearing callbacks should restore the fast path"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_processing_path_follows_configuration():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, enable_stats=False)
+    key = "test_user"
+    callback_results = []
+
+    await rate_limiter.allow_request(key)
+    assert rate_limiter.get_stats(key) == {"error": "Stats collection is disabled"}, "Stats should be disabled"
+
+    rate_limiter.add_callback(lambda allowed, key: callback_results.append(allowed))
+    await rate_limiter.allow_request(key)
+    assert callback_results == [True], "Callback added after construction should be triggered"
+
+    rate_limiter.enable_stats_collection()
+    await rate_limiter.allow_request(key)
+    assert rate_limiter.get_stats(key)["total_allowed"] == 1, "Stats should be collected once re-enabled"
+    assert rate_limiter.tokens[key] == pytest.approx(7, abs=0.01), "Every request should consume a token on either path"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_callbacks_list_changed_in_place():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, enable_stats=False)
+    callback_results = []
+
+    async def async_callback(allowed, key):
+        callback_results.append("async")
+
+    def sync_callback(allowed, key):
+        callback_results.append("sync")
+
+    rate_limiter.callbacks.append(sync_callback)
+    rate_limiter.callbacks.insert(0, async_callback)
+    await rate_limiter.allow_request("test_user")
+
+    assert callback_results == ["async", "sync"], f"Callbacks added to the list directly should run in list order, got {callback_results}"
+
+    rate_limiter.callbacks.remove(async_callback)
+    del rate_limiter.callbacks[0]
+    await rate_limiter.allow_request("test_user")
+
+    assert callback_results == ["async", "sync"], "Callbacks removed from the list directly should no longer run"
+    assert rate_limiter._process_request == rate_limiter._process_request_fast, "Emptying the list should restore the fast path"
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_enable_stats_assignment_switches_path():
+    rate_limiter = RateLimiter(rate=10, seconds=60, capacity=10, enable_stats=False)
+    key = "test_user"
+
+    rate_limiter.enable_stats = True
+    await rate_limiter.allow_request(key)
+    assert rate_limiter.get_stats(key)["total_allowed"] == 1, "Setting enable_stats directly should start collecting stats"
+
+    rate_limiter.enable_stats = False
+    assert rate_limiter._process_request == rate_limiter._process_request_fast, "Clearing enable_stats directly should restore the fast path"
+
 # ------- Advanced scenarios and edge cases ------- #
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_simultaneous_requests(rate_limiter):
     key = "test_user"
 
     async def make_request():
-        try:
-            _ = await rate_limiter.allow_request(key)
-            print(f"Request Allowed")
-        except HTTPException as e:
-            print(f"Request Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key)
 
     tasks = [make_request() for _ in range(15)]
     await asyncio.gather(*tasks)
 
     stats = rate_limiter.get_stats(key)
-    print(f"Stats after simultaneous requests: {stats}")
     assert stats["total_allowed"] == 15, "Expected all requests to be allowed within the burst"
 
-@pytest.mark.asyncio
-async def test_high_volume_over_time(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_high_volume_over_time(rate_limiter, fake_clock):
     key = "test_user"
     allowed_count = 0
 
     for i in range(100):
-        try:
-            await asyncio.sleep(0.1)
-            _ = await rate_limiter.allow_request(key)
+        fake_clock.advance(0.1)
+        await asyncio.sleep(0)
+        if await rate_limiter.try_allow_request(key):
             allowed_count += 1
-        except HTTPException as e:
-            print(f"Request {i+1}: Denied - {e.detail}")
 
-    print(f"Total allowed requests: {allowed_count}")
     stats = rate_limiter.get_stats(key)
     assert stats["total_allowed"] <= 100, "Allowed requests should be limited within the rate limit"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_different_keys_overlapping(rate_limiter):
     key1 = "user1"
     key2 = "user2"
 
     async def make_request(key):
-        try:
-            _ = await rate_limiter.allow_request(key)
-            print(f"Request for {key}: Allowed")
-        except HTTPException as e:
-            print(f"Request for {key}: Denied - {e.detail}")
+        await rate_limiter.try_allow_request(key)
 
     tasks = [make_request(key1), make_request(key2), make_request(key1), make_request(key2)]
     await asyncio.gather(*tasks)
@@ -659,21 +953,17 @@ async def test_different_keys_overlapping(rate_limiter):
     assert stats_key1["total_allowed"] == 2, "Both requests for key1 should be allowed"
     assert stats_key2["total_allowed"] == 2, "Both requests for key2 should be allowed"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_wait_time_calculation(rate_limiter):
     key = "test_user"
 
     for _ in range(15):
-        try:
-            await rate_limiter.allow_request(key)
-        except HTTPException:
-            pass
+        await rate_limiter.try_allow_request(key)
 
     wait_time = await rate_limiter.get_wait_time(key)
-    print(f"Calculated wait time: {wait_time}")
     assert wait_time > 0, "Wait time should be greater than zero after exceeding limit"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_stats_reset_on_key(rate_limiter):
     key = "test_user"
 
@@ -688,8 +978,8 @@ async def test_stats_reset_on_key(rate_limiter):
     stats_after = rate_limiter.get_stats(key)
     assert stats_after["total_allowed"] == 0, "Stats should be reset to 0 after reset"
     
-@pytest.mark.asyncio
-async def test_dynamic_rate_change(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_dynamic_rate_change(rate_limiter, fake_clock):
     key = "test_user"
     
     rate_limiter.reset(key)
@@ -708,14 +998,15 @@ async def test_dynamic_rate_change(rate_limiter):
     
     assert rate_limiter.rate == new_rate, f"Expected rate to be {new_rate}, got {rate_limiter.rate}"
     
-    await asyncio.sleep(rate_limiter.time / new_rate)
+    fake_clock.advance(rate_limiter.time / new_rate + 0.01)
+    await asyncio.sleep(0)
     
     await rate_limiter.allow_request(key)
     
     rate_limiter.update_rate(initial_rate)
     
-@pytest.mark.asyncio
-async def test_dynamic_capacity_change(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_dynamic_capacity_change(rate_limiter, fake_clock):
     key = "test_user"
 
     rate_limiter.reset(key)
@@ -734,15 +1025,14 @@ async def test_dynamic_capacity_change(rate_limiter):
 
     assert rate_limiter.capacity == new_capacity, f"Expected capacity to be {new_capacity}, got {rate_limiter.capacity}"
 
-    await asyncio.sleep(rate_limiter.time / rate_limiter.rate)
+    fake_clock.advance(rate_limiter.time / rate_limiter.rate + 0.01)
+    await asyncio.sleep(0)
 
     additional_allowed = 0
     for _ in range(new_capacity - initial_capacity):
-        try:
-            await rate_limiter.allow_request(key)
-            additional_allowed += 1
-        except HTTPException:
+        if not await rate_limiter.try_allow_request(key):
             break
+        additional_allowed += 1
 
     assert additional_allowed > 0, f"Expected to allow additional requests after increasing capacity, but got {additional_allowed}"
 
@@ -754,11 +1044,9 @@ async def test_dynamic_capacity_change(rate_limiter):
     rate_limiter.reset(key)
     allowed_count = 0
     for _ in range(lower_capacity + initial_burst):
-        try:
-            await rate_limiter.allow_request(key)
-            allowed_count += 1
-        except HTTPException:
+        if not await rate_limiter.try_allow_request(key):
             break
+        allowed_count += 1
 
     assert allowed_count == lower_capacity + initial_burst, f"Expected {lower_capacity + initial_burst} allowed requests after decreasing capacity, but got {allowed_count}"
 
@@ -767,8 +1055,8 @@ async def test_dynamic_capacity_change(rate_limiter):
 
     rate_limiter.update_capacity(initial_capacity)
 
-@pytest.mark.asyncio
-async def test_dynamic_time_change(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_dynamic_time_change(rate_limiter, fake_clock):
     key = "test_user"
     
     rate_limiter.reset(key)
@@ -787,18 +1075,20 @@ async def test_dynamic_time_change(rate_limiter):
     
     assert rate_limiter.time == new_time_seconds, f"Expected time to be {new_time_seconds}, got {rate_limiter.time}"
     
-    await asyncio.sleep(initial_time / rate_limiter.rate)
+    fake_clock.advance(initial_time / rate_limiter.rate + 0.01)
+    await asyncio.sleep(0)
     
     with pytest.raises(HTTPException):
         await rate_limiter.allow_request(key)
     
-    await asyncio.sleep(initial_time / rate_limiter.rate)
+    fake_clock.advance(initial_time / rate_limiter.rate + 0.01)
+    await asyncio.sleep(0)
     
     await rate_limiter.allow_request(key)
     
     rate_limiter.update_time(seconds=initial_time)
     
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_dynamic_burst_change(rate_limiter):
     key = "test_user"
 
@@ -822,18 +1112,24 @@ async def test_dynamic_burst_change(rate_limiter):
 
     additional_allowed = 0
     for _ in range(new_burst - initial_burst):
-        try:
-            await rate_limiter.allow_request(key)
-            additional_allowed += 1
-        except HTTPException:
+        if not await rate_limiter.try_allow_request(key):
             break
+        additional_allowed += 1
 
     assert additional_allowed == new_burst - initial_burst, f"Expected to allow {new_burst - initial_burst} additional requests after increasing burst, but got {additional_allowed}"
 
+    with pytest.raises(HTTPException):
+        await rate_limiter.allow_request(key)
+
+    rate_limiter.update_burst(new_burst)
+
+    with pytest.raises(HTTPException):
+        await rate_limiter.allow_request(key)
+
     rate_limiter.update_burst(initial_burst)
 
-@pytest.mark.asyncio
-async def test_dynamic_stats_window_change(rate_limiter):
+@pytest.mark.asyncio(loop_scope="session")
+async def test_dynamic_stats_window_change(rate_limiter, fake_clock):
     key = "test_user"
 
     rate_limiter.reset(key)
@@ -842,7 +1138,8 @@ async def test_dynamic_stats_window_change(rate_limiter):
     for _ in range(5):
         await rate_limiter.allow_request(key)
 
-    await asyncio.sleep(initial_stats_window / 2)
+    fake_clock.advance(initial_stats_window / 2)
+    await asyncio.sleep(0)
 
     for _ in range(5):
         await rate_limiter.allow_request(key)
@@ -862,7 +1159,23 @@ async def test_dynamic_stats_window_change(rate_limiter):
     assert updated_stats["window_allowed"] <= 10, f"Expected 10 or fewer allowed requests in updated window, got {updated_stats['window_allowed']}"
 
     rate_limiter.update_stats_window(initial_stats_window)
-    
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_stats_window_change_applies_to_new_keys(rate_limiter):
+    await rate_limiter.allow_request("existing_user")
+
+    rate_limiter.update_stats_window(5)
+
+    for _ in range(8):
+        await rate_limiter.allow_request("existing_user")
+        await rate_limiter.allow_request("new_user")
+
+    assert rate_limiter.request_history["existing_user"].maxlen == 5, "Existing history should use the new stats window"
+    assert rate_limiter.request_history["new_user"].maxlen == 5, "History created after the change should use the new stats window"
+
+    stats = rate_limiter.get_stats("existing_user")
+    assert stats["window_allowed"] == 9, f"Window counts should cover every request in the window, got {stats['window_allowed']}"
+
 # ------- Security Tests ------- #
 @pytest.fixture
 def secure_rate_limiter():
@@ -872,7 +1185,8 @@ def secure_rate_limiter():
         capacity=10,
         burst=5,
         stats_window=20,
-        enable_stats=True
+        enable_stats=True,
+        max_keys=1000
     )
 
 @pytest.fixture
@@ -888,48 +1202,48 @@ def secure_app(secure_rate_limiter):
 
 @pytest.fixture
 def secure_client(secure_app):
-    return TestClient(secure_app)
+    # Entering the client keeps one blocking portal, and its event loop thread, alive for every request of the test
+    with TestClient(secure_app) as client:
+        yield client
 
-def test_ip_spoofing_prevention(secure_client):
+def test_ip_spoofing_prevention(secure_client, secure_rate_limiter):
     headers_1 = {"X-Forwarded-For": "192.168.1.1"}
     headers_2 = {"X-Forwarded-For": "192.168.1.2"}
 
-    for _ in range(15):
-        secure_client.get("/secure-test", headers=headers_1)
+    secure_client.get("/secure-test", headers=headers_1)
+    secure_rate_limiter._drain("testclient", 14)
 
     response = secure_client.get("/secure-test", headers=headers_2)
     
     assert response.status_code == 429, "Rate limiter should not be fooled by X-Forwarded-For header"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_timing_attack_resistance(secure_rate_limiter):
     key = "test_user"
 
-    start = asyncio.get_event_loop().time()
+    start = time.perf_counter()
     await secure_rate_limiter.allow_request(key)
-    allowed_time = asyncio.get_event_loop().time() - start
+    allowed_time = time.perf_counter() - start
 
-    for _ in range(14):
-        await secure_rate_limiter.allow_request(key)
+    secure_rate_limiter._drain(key, 14)
 
-    start = asyncio.get_event_loop().time()
+    start = time.perf_counter()
     with pytest.raises(HTTPException):
         await secure_rate_limiter.allow_request(key)
-    denied_time = asyncio.get_event_loop().time() - start
+    denied_time = time.perf_counter() - start
 
     time_difference = abs(denied_time - allowed_time)
     assert time_difference < 0.1, "Time to process allowed and denied requests should be similar"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_key_exhaustion_prevention(secure_rate_limiter):
     for i in range(10000):
         key = f"unique_key_{i}"
-        try:
-            await secure_rate_limiter.allow_request(key)
-        except HTTPException:
-            pass
+        await secure_rate_limiter.try_allow_request(key)
 
     assert await secure_rate_limiter.allow_request("test_key"), "Rate limiter should still function after many unique keys"
+    assert len(secure_rate_limiter.tokens) <= 1000, f"Tracked keys should stay bounded, got {len(secure_rate_limiter.tokens)}"
+    assert len(secure_rate_limiter.request_history) <= 1000, "Evicted keys should not leave their history behind"
 
 def test_header_injection_prevention(secure_client):
     malicious_headers = {
@@ -941,15 +1255,8 @@ def test_header_injection_prevention(secure_client):
     
     assert "X-Custom-Header" not in response.headers, "Rate limiter should not allow header injection"
 
-@pytest.mark.asyncio
+@pytest.mark.asyncio(loop_scope="session")
 async def test_ddos_protection():
-    def run_server(app, should_exit):
-        config = uvicorn.Config(app, host="127.0.0.1", port=8000, log_level="critical")
-        server = uvicorn.Server(config)
-        server.install_signal_handlers = lambda: None
-        while not should_exit.is_set():
-            server.run(sockets=None)
-
     app = FastAPI()
 
     rate_limiter = RateLimiter(
@@ -963,52 +1270,75 @@ async def test_ddos_protection():
 
     setup_rate_limiter(app, rate_limiter)
 
-    should_exit = threading.Event()
+    # Route the burst through the app in-process; only the limiter's denials are under test, not the TCP stack
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        tasks = [client.get("/test") for _ in range(1000)]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
 
-    server_thread = threading.Thread(target=run_server, args=(app, should_exit))
-    server_thread.start()
+    # Count denials in a single pass by summing booleans, treating transport errors as denials
+    denied = sum(isinstance(r, Exception) or r.status_code == 429 for r in responses)
 
-    time.sleep(5)
+    assert denied > 900, f"Expected over 900 denied requests during DDoS simulation, got {denied}"
 
-    try:
-        async with httpx.AsyncClient() as client:
-            async def ddos_attack():
-                tasks = []
-                for _ in range(1000):
-                    tasks.append(client.get("http://127.0.0.1:8000/test"))
-                    await asyncio.sleep(0.001)
-                return await asyncio.gather(*tasks, return_exceptions=True)
+@pytest.mark.asyncio(loop_scope="session")
+async def test_race_condition_handling(secure_rate_limiter):
+    key = "test_user"
 
-            responses = await ddos_attack()
+    try_allow_request = secure_rate_limiter.try_allow_request
+    results = await asyncio.gather(*[try_allow_request(key) for _ in range(100)])
 
-        _ = sum(1 for r in responses if not isinstance(r, Exception) and r.status_code == 200)
-        denied = sum(1 for r in responses if isinstance(r, httpx.HTTPStatusError) and r.response.status_code == 429)
-        errors = sum(1 for r in responses if isinstance(r, Exception) and not isinstance(r, httpx.HTTPStatusError))
+    allowed = results.count(True)
+    assert allowed == 15, f"Expected exactly 15 allowed requests under concurrent load, got {allowed}"
 
-        denied += errors
+@pytest.mark.asyncio(loop_scope="session")
+async def test_race_condition_with_yielding_callback(secure_rate_limiter):
+    key = "test_user"
 
-        assert denied > 900, f"Expected over 900 denied requests during DDoS simulation, got {denied}"
+    async def yielding_callback(allowed, key):
+        await asyncio.sleep(0)
 
-    finally:
-        should_exit.set()
-        server_thread.join(timeout=5)
+    secure_rate_limiter.add_callback(yielding_callback)
 
-@pytest.mark.asyncio
-async def test_race_condition_handling(secure_rate_limiter):
-    key = "test_user"
+    try_allow_request = secure_rate_limiter.try_allow_request
+    results = await asyncio.gather(*[try_allow_request(key) for _ in range(100)])
 
-    async def make_request():
-        try:
-            await secure_rate_limiter.allow_request(key)
-            return "allowed"
-        except HTTPException:
-            return "denied"
+    allowed = results.count(True)
+    assert allowed == 15, f"Expected exactly 15 allowed requests when callbacks yield to the event loop, got {allowed}"
 
-    tasks = [make_request() for _ in range(100)]
-    results = await asyncio.gather(*tasks)
+# ------- Benchmarks ------- #
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
 
-    allowed = results.count("allowed")
-    assert allowed == 15, f"Expected exactly 15 allowed requests under concurrent load, got {allowed}"
+requires_benchmark = pytest.mark.skipif(pytest_benchmark is None, reason="pytest-benchmark is not installed")
+
+# Run a coroutine that never suspends to completion without an event loop, so only the limiter itself is timed
+def run_to_completion(coroutine):
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("Coroutine suspended unexpectedly")
+
+@requires_benchmark
+@pytest.mark.benchmark(group="hot-path")
+def test_bench_allow_request(benchmark, rate_limiter):
+    rate_limiter.update_capacity(10**9)
+
+    allowed = benchmark(lambda: run_to_completion(rate_limiter.allow_request("k")))
+
+    assert allowed, "Requests should never be denied at this capacity"
+
+@requires_benchmark
+@pytest.mark.benchmark(group="hot-path")
+def test_bench_allow_request_many_keys(benchmark, rate_limiter):
+    rate_limiter.update_capacity(10**9)
+    keys = itertools.cycle([f"key_{i}" for i in range(1000)])
+
+    allowed = benchmark(lambda: run_to_completion(rate_limiter.allow_request(next(keys))))
+
+    assert allowed, "Requests should never be denied at this capacity"
 
 if __name__ == "__main__":
     pytest.main([__file__])
\ No newline at end of file